@@ -2,21 +2,80 @@
 
 import os
 import os.path
+import re
+import json
 import platform
 import shlex
 import queue
-import codecs
+import mmap
 import sqlite3
 import fnmatch
+import hashlib
 import threading
-import subprocess
+import time
 from textwrap import dedent
-from collections import OrderedDict
-
-
-DD_BLKSIZE = 512
-MAX_BLOCKS = 20480
-MAX_FILE_SIZE = DD_BLKSIZE*MAX_BLOCKS
+from operator import itemgetter
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+MAX_FILE_SIZE = 512*20480
+READ_CHUNK_SIZE = 1 << 20
+# files at least this big get memory mapped rather than read for hashing
+MMAP_MIN_SIZE = 1 << 20
+# files at least this big get hashed with all cores when using blake3
+PARALLEL_HASH_SIZE = 4 << 20
+
+HASHERS = {"sha256": hashlib.sha256}
+if blake3 is not None:
+    HASHERS["blake3"] = blake3.blake3
+# much faster, but not cryptographic, so only by request
+if xxhash is not None:
+    HASHERS["xxh3"] = xxhash.xxh3_128
+DEFAULT_HASH = "blake3" if blake3 is not None else "sha256"
+HASH_NAME = DEFAULT_HASH
+HASHER = HASHERS[HASH_NAME]
+
+# fingerprints only need to tell files apart, not resist tampering
+if xxhash is not None:
+    FINGERPRINT_NAME, FINGERPRINTER = "xxh3", xxhash.xxh3_128
+elif blake3 is not None:
+    FINGERPRINT_NAME, FINGERPRINTER = "blake3", blake3.blake3
+else:
+    FINGERPRINT_NAME, FINGERPRINTER = "blake2b", hashlib.blake2b
+FINGERPRINT_SIZE = 4096
+
+HASH_WORKERS = os.cpu_count() or 1
+# files queued on the pool at once, enough to keep it busy without
+# holding a future for every file in the tree
+MAX_IN_FLIGHT = 4 * HASH_WORKERS
+# read files in inode order, which is roughly on-disk order, to spare disk seeks
+DISK_ORDER = False
+
+# flush queued rows to the database after this many rows or seconds
+BATCH_ROWS = 500
+BATCH_SECONDS = 0.25
+# rows pulled from the database at a time when streaming query results
+FETCH_ROWS = 1024
+# write buffer for generated scripts
+SCRIPT_BUFFER = 1 << 20
+
+# index name -> (table, column)
+INDICES = {
+    f"{side}_{column}": (f"{side}_files", column)
+    for side in ("a", "b")
+    for column in ("hash", "size", "relpath", "fingerprint")
+}
 
 
 ignore = {
@@ -24,36 +83,158 @@ ignore = {
     '.sync*',
     '*Thumbs.db',
 }
+# patterns without wildcards only match themselves, so a set lookup does;
+# the rest are compiled into one regex
+LITERAL_IGNORES = frozenset(p for p in ignore if not any(c in p for c in "*?["))
+IGNORE_RE = re.compile("|".join(fnmatch.translate(p) for p in ignore - LITERAL_IGNORES)
+                       or "(?!)")
 
 
 def is_ignored(rel_fname):
     """Return True if the file should be ignored"""
-    for pattern in ignore:
-        if fnmatch.fnmatch(rel_fname, pattern):
-            return True
-    return False
+    return rel_fname in LITERAL_IGNORES or IGNORE_RE.match(rel_fname) is not None
+
+
+def new_hasher(file_size):
+    """Make a fresh HASHER, letting blake3 use every core on big files"""
+    if blake3 is not None and HASHER is blake3.blake3 \
+            and file_size >= PARALLEL_HASH_SIZE:
+        return HASHER(max_threads=HASHER.AUTO)
+    return HASHER()
+
+
+def hash_file(filename):
+    """Get the HASHER hash (blake3, SHA256 or xxh3) of the first 10MB of a file"""
+    with open(filename, "rb") as f:
+        length = min(os.fstat(f.fileno()).st_size, MAX_FILE_SIZE)
+        h = new_hasher(length)
+
+        # big files are hashed straight out of the page cache
+        if length >= MMAP_MIN_SIZE:
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, length, os.POSIX_FADV_SEQUENTIAL)
+                os.posix_fadvise(f.fileno(), 0, length, os.POSIX_FADV_WILLNEED)
+            with mmap.mmap(f.fileno(), length, access=mmap.ACCESS_READ) as mm:
+                h.update(mm)
+            return h.hexdigest()
+
+        remaining = MAX_FILE_SIZE
+        while remaining > 0:
+            chunk = f.read(min(READ_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            h.update(chunk)
+            remaining -= len(chunk)
+
+    return h.hexdigest()
+
+
+# persistent cache of file hashes and fingerprints between runs, see open_hash_cache()
+hash_cache = None
+hash_cache_lock = threading.Lock()
+hash_cache_inserts = 0
+
+
+def open_hash_cache(cache_file):
+    """Start remembering file hashes and fingerprints in cache_file, keyed by inode"""
+    global hash_cache
+    hash_cache = sqlite3.connect(cache_file, check_same_thread=False)
+    hash_cache.execute("PRAGMA journal_mode=WAL")
+    hash_cache.execute("PRAGMA synchronous=NORMAL")
+    # caches from before fingerprints were cached have no kind column;
+    # they're only a cache, so start those over
+    columns = [row[1] for row in hash_cache.execute("PRAGMA table_info(hash_cache)")]
+    if columns and "kind" not in columns:
+        hash_cache.execute("DROP TABLE hash_cache")
+    hash_cache.execute('''CREATE TABLE IF NOT EXISTS hash_cache
+                 (dev integer, ino integer, kind text, algorithm text, size integer,
+                  mtime_ns integer, hash text,
+                  PRIMARY KEY (dev, ino, kind, algorithm))''')
+    hash_cache.commit()
+
+
+def close_hash_cache():
+    global hash_cache
+    if hash_cache is not None:
+        hash_cache.commit()
+        hash_cache.close()
+        hash_cache = None
+
+
+def cached_digest(filename, kind, algorithm, compute):
+    """
+    Get compute(filename), reusing the result in the hash cache (if open)
+    when the file's size and modification time haven't changed
+
+    kind and algorithm keep hashes and fingerprints of each flavour apart
+    """
+    global hash_cache_inserts
+    if hash_cache is None:
+        return compute(filename)
+
+    st = os.stat(filename)
+    key = (st.st_dev, st.st_ino, kind, algorithm)
+    with hash_cache_lock:
+        row = hash_cache.execute("""
+            SELECT size, mtime_ns, hash FROM hash_cache
+                WHERE dev = ? AND ino = ? AND kind = ? AND algorithm = ?
+            """, key).fetchone()
+    if row is not None and row[:2] == (st.st_size, st.st_mtime_ns):
+        return row[2]
+
+    digest = compute(filename)
+    with hash_cache_lock:
+        hash_cache.execute("INSERT OR REPLACE INTO hash_cache VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           (*key, st.st_size, st.st_mtime_ns, digest))
+        hash_cache_inserts += 1
+        if hash_cache_inserts % BATCH_ROWS == 0:
+            hash_cache.commit()
+    return digest
 
 
 def get_hash(filename):
-    """Get the SHA256 hash of the first 10MB of a file"""
-    if os.stat(filename).st_size < MAX_FILE_SIZE:
-        res = subprocess.check_output(['shasum', '-a', '256', filename])
-    else:
-        p1 = subprocess.Popen(
-            ["dd", f"if={filename}", f"count={MAX_BLOCKS}"],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.DEVNULL,
-        )
-        p2 = subprocess.Popen(
-            ["shasum", "-a", "256"],
-            stdin=p1.stdout,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.DEVNULL,
-        )
-        p1.stdout.close()
-        res = p2.communicate()[0]
-
-    return res.split()[0].decode("ASCII")
+    """Get the hash of a file, from the hash cache if it's still good"""
+    return cached_digest(filename, "hash", HASH_NAME, hash_file)
+
+
+def fingerprint_file(filename):
+    """
+    Cheaply identify a file by hashing its size and first and last 4KB
+
+    Files with different fingerprints are certainly different, files
+    with the same fingerprint need a full get_hash() to tell them apart
+    """
+    with open(filename, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        h = FINGERPRINTER(str(size).encode("ASCII"))
+        h.update(f.read(FINGERPRINT_SIZE))
+        if size > FINGERPRINT_SIZE:
+            f.seek(max(size - FINGERPRINT_SIZE, FINGERPRINT_SIZE))
+            h.update(f.read(FINGERPRINT_SIZE))
+
+    return h.hexdigest()
+
+
+def get_fingerprint(filename):
+    """Get the fingerprint of a file, from the hash cache if it's still good"""
+    return cached_digest(filename, "fingerprint", FINGERPRINT_NAME, fingerprint_file)
+
+
+def is_rotational(path):
+    """Return True if path looks to be on a spinning disk (only known on Linux)"""
+    try:
+        dev = os.stat(path).st_dev
+    except OSError:
+        return False
+    sys_dev = f"/sys/dev/block/{os.major(dev)}:{os.minor(dev)}"
+    # partitions keep their queue settings on the parent device
+    for block_dir in (sys_dev, os.path.join(sys_dev, "..")):
+        try:
+            with open(os.path.join(block_dir, "queue", "rotational")) as f:
+                return f.read().strip() == "1"
+        except OSError:
+            continue
+    return False
 
 
 def make_executable(path):
@@ -62,51 +243,184 @@ def make_executable(path):
     os.chmod(path, mode)
 
 
-def grok_dir(the_dir, callbak, get_hashes=True):
-    for root, dirs, files in os.walk(the_dir):
-        for name in files:
-            full_name = os.path.join(root, name)
-            relpath = os.path.relpath(full_name, start=the_dir)
+def walk_dir(the_dir, rel_root=''):
+    """Yield (full_name, relpath, file_size, inode) for each regular file in the_dir"""
+    try:
+        entries = os.scandir(os.path.join(the_dir, rel_root))
+    except OSError as err:
+        print(f"Skipping unreadable dir: {err}")
+        return
+
+    with entries:
+        for entry in entries:
+            relpath = os.path.join(rel_root, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                yield from walk_dir(the_dir, relpath)
+                continue
+
             if is_ignored(relpath):
                 print(f"Skipping file: {relpath}")
                 continue
 
-            full_path = os.path.join(the_dir, relpath)
-
             # skip the file if it's not a regular file (like a symlink)
-            if not os.path.isfile(full_path):
+            if not entry.is_file(follow_symlinks=False):
                 print(f"Skipping non-file: {relpath}")
                 continue
 
-            file_size = os.stat(full_path).st_size
+            yield (entry.path, relpath, entry.stat(follow_symlinks=False).st_size,
+                   entry.inode())
+
+
+def map_bounded(executor, fn, items):
+    """
+    Yield (item, fn(item[0])) for each tuple in items as it finishes on
+    executor, with at most MAX_IN_FLIGHT submitted at a time
+    """
+    pending = {}
+    for item in items:
+        if len(pending) >= MAX_IN_FLIGHT:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+        pending[executor.submit(fn, item[0])] = item
+
+    for future in as_completed(pending):
+        yield pending[future], future.result()
+
+
+def grok_dir(the_dir, callbak, get_fingerprints=True, executor=None):
+    """
+    Walk the_dir and pass (fingerprint, size, the_dir, relpath, inode) for each file to callbak
 
-            if get_hashes:
-                print(f"Hashing file: {full_name}")
-                file_hash = get_hash(full_path)
-            else:
-                print(f"Checked file size: {full_name}")
-                file_hash = ''
+    Fingerprints are computed on executor (a fresh pool if none is given)
+    and handed to callbak as they complete, so not in walk order
+    """
+    if not get_fingerprints:
+        for full_name, relpath, file_size, inode in walk_dir(the_dir):
+            print(f"Checked file size: {full_name}")
+            callbak(None, file_size, the_dir, relpath, inode)
+        return
+
+    if executor is None:
+        with ThreadPoolExecutor(max_workers=HASH_WORKERS) as executor:
+            return grok_dir(the_dir, callbak, executor=executor)
 
-            callbak(file_hash, file_size, the_dir, relpath)
+    files = walk_dir(the_dir)
+    if DISK_ORDER:
+        files = sorted(files, key=itemgetter(3))
+
+    for (full_name, relpath, file_size, inode), fingerprint in map_bounded(executor, get_fingerprint, files):
+        print(f"Fingerprinted file: {full_name}")
+        callbak(fingerprint, file_size, the_dir, relpath, inode)
 
 
 def db_setup(db_file=":memory:"):
     conn = sqlite3.connect(db_file)
     cursor = conn.cursor()
 
-    cursor.execute('''CREATE TABLE IF NOT EXISTS a_files
-                 (hash text, size integer, start_dir text, relpath text)''')
-    cursor.execute('''CREATE TABLE IF NOT EXISTS b_files
-                 (hash text, size integer, start_dir text, relpath text)''')
+    # WAL lets us commit in batches without an fsync storm
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-65536")
+
+    for table in ("a_files", "b_files"):
+        cursor.execute(f'''CREATE TABLE IF NOT EXISTS {table}
+                 (hash text, size integer, start_dir text, relpath text,
+                  fingerprint text, inode integer)''')
+        # databases from older versions lack the newer columns
+        columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({table})")]
+        for column, column_type in (("fingerprint", "text"), ("inode", "integer")):
+            if column not in columns:
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+    db_create_indices(cursor)
 
     conn.commit()
 
     return conn, cursor
 
 
+def db_create_indices(c):
+    for index, (table, column) in INDICES.items():
+        c.execute(f"CREATE INDEX IF NOT EXISTS {index} ON {table}({column})")
+
+
+def db_drop_indices(c):
+    """Drop the indices so bulk inserts don't pay to maintain them per row"""
+    for index in INDICES:
+        c.execute(f"DROP INDEX IF EXISTS {index}")
+
+
+def db_resolve_hashes(c, executor):
+    """
+    Give every fingerprinted file without a hash one
+
+    Only files whose fingerprint is shared with another file (in either
+    table) can be identical to something, so only those are fully hashed.
+    The rest are unique and get their fingerprint as a stand-in hash,
+    prefixed so it never equals a real hash.
+    """
+    c.execute('''WITH collisions AS (
+                        SELECT fingerprint FROM (
+                            SELECT fingerprint FROM a_files
+                            UNION ALL
+                            SELECT fingerprint FROM b_files)
+                        GROUP BY fingerprint
+                        HAVING COUNT(*) > 1)
+                    SELECT 'a_files', start_dir, relpath, inode FROM a_files
+                        WHERE hash IS NULL AND fingerprint IN collisions
+                    UNION ALL
+                    SELECT 'b_files', start_dir, relpath, inode FROM b_files
+                        WHERE hash IS NULL AND fingerprint IN collisions''' +
+              (" ORDER BY inode" if DISK_ORDER else ""))
+    collisions = c.fetchall()
+
+    print(f"Found {len(collisions)} files with matching fingerprints")
+
+    files = ((os.path.join(start_dir, relpath), table, start_dir, relpath)
+             for table, start_dir, relpath, _ in collisions)
+    updates = {"a_files": [], "b_files": []}
+    for (full_path, table, start_dir, relpath), file_hash in map_bounded(executor, get_hash, files):
+        print(f"Hashed file: {full_path}")
+        updates[table].append((file_hash, start_dir, relpath))
+
+    for table, rows in updates.items():
+        c.executemany(f"""
+            UPDATE {table}
+            SET hash = ?
+            WHERE start_dir = ? AND relpath = ?
+        """, rows)
+        c.execute(f"""
+            UPDATE {table}
+            SET hash = 'fp:' || fingerprint
+            WHERE hash IS NULL AND fingerprint IS NOT NULL
+        """)
+    c.connection.commit()
+
+
+def short_hash(column):
+    """
+    SQL showing the start of the hash in column, labelled 'fingerprint:'
+    for the stand-in of a file with a unique fingerprint, or 'unhashed'
+    for a file that was never looked at (dir_a files in --absorb)
+    """
+    return f"""CASE WHEN {column} IS NULL THEN 'unhashed'
+                    WHEN {column} LIKE 'fp:%' THEN 'fingerprint:' || substr({column}, 4, 16)
+                    ELSE substr({column}, 0, 20) END"""
+
+
+def iter_rows(c):
+    """Stream the results of the last query on c in batches of FETCH_ROWS"""
+    while True:
+        rows = c.fetchmany(FETCH_ROWS)
+        if not rows:
+            return
+        yield from rows
+
+
 def db_query_missing(c, ignore_paths=[], a_only=False):
     """
-    Find files that are missing from one or another directory
+    Yield files that are missing from one or another directory
 
     Uses the file hahshes, so isn't fooled by files that are just moved
     Ignores paths in ignore_paths (good for skipping files that changed)
@@ -117,88 +431,108 @@ def db_query_missing(c, ignore_paths=[], a_only=False):
     if len(ignore_paths) > 0:
         c.executemany("INSERT INTO ignore_paths VALUES (?)", [(p, ) for p in ignore_paths])
 
-    query = '''SELECT substr(hash, 0, 20) AS short_hash, start_dir, relpath
-                    FROM {1}
-                    WHERE {1}.hash NOT IN (SELECT hash FROM {0})
-                        AND {1}.relpath NOT IN (SELECT relpath FROM ignore_paths)
+    # anti-join: rows of {1} with no hash match in {0}
+    query = f'''SELECT {short_hash("this.hash")} AS short_hash, this.start_dir, this.relpath
+                    FROM {{1}} this
+                    LEFT JOIN {{0}} other ON other.hash = this.hash
+                    WHERE other.hash IS NULL
+                        AND this.relpath NOT IN (SELECT relpath FROM ignore_paths)
                     '''
 
+    # each query's rows all share one start_dir, so they come out grouped by it
     c.execute(query.format("a_files", "b_files"))
-    not_in_a = c.fetchall()
+    yield from iter_rows(c)
     if a_only:
-        return not_in_a
+        return
 
     c.execute(query.format("b_files", "a_files"))
-    return not_in_a + c.fetchall()
+    yield from iter_rows(c)
 
 
 def db_query_moved(c):
     """
     Find files that have just moved
     """
-    c.execute('''CREATE TEMP TABLE hashjoin AS
-                    SELECT substr(a.hash, 0, 20) AS short_hash, a.relpath AS a_path, b.relpath AS b_path
-                    FROM a_files a, b_files b
-                    WHERE b.hash = a.hash''')
-    # these are paths that have definitely not moved: they have equal hash+path
-    # without this check, duplicates in different paths would show up as moved
-    c.execute('''CREATE TEMP TABLE excluded AS
-                    SELECT a_path FROM hashjoin WHERE a_path = b_path''')
-    c.execute('''SELECT short_hash, a_path, b_path
-                    FROM hashjoin
-                    WHERE a_path != b_path
-                    AND a_path NOT IN excluded
-                    AND b_path NOT IN excluded''')
-    return c.fetchall()
+    c.execute(f'''WITH hashjoin AS (
+                        SELECT hash, a.relpath AS a_path, b.relpath AS b_path
+                            FROM a_files a
+                            JOIN b_files b USING (hash)),
+                    -- these are paths that have definitely not moved: they have equal hash+path
+                    -- without this check, duplicates in different paths would show up as moved
+                    excluded AS (
+                        SELECT a_path FROM hashjoin WHERE a_path = b_path)
+                    SELECT {short_hash("hash")} AS short_hash, a_path, b_path
+                        FROM hashjoin
+                        WHERE a_path != b_path
+                        AND a_path NOT IN excluded
+                        AND b_path NOT IN excluded''')
+    return iter_rows(c)
 
 
 def db_query_duplicates(c, table="a_files"):
     """
-    Return a dictionary of duplicate files indexed by hash and
-    ordered by their starting directory
+    Return a dictionary of duplicate files indexed by hash, with the
+    groups and the paths within each ordered by path
 
     Returns:
         { '12afeed843...': ['/path/to/copy.1', '/path/to/copy.2'], ... }
     """
-    c.execute(f"""SELECT hash, start_dir, relpath
+    c.execute(f"""SELECT hash, json_group_array(rtrim(start_dir, '/') || '/' || relpath)
                     FROM {table}
-                    WHERE hash IN (
-                        SELECT hash FROM {table}
-                            GROUP BY hash
-                            HAVING ( COUNT(hash) > 1 ))
-                    ORDER BY start_dir""")
-    duplicates = c.fetchall()
-
-    # group the duplicates into buckets by hash, preserving their
-    # ordering by directory
-    # sorting by directory makes it easier to go through by
-    # hand and decide what to do with each file
-    dupes_by_hash = OrderedDict()
-    for short_hash, start_dir, relpath in duplicates:
-        if short_hash not in dupes_by_hash:
-            dupes_by_hash[short_hash] = []
-        dupes_by_hash[short_hash].append(os.path.join(start_dir, relpath))
+                    GROUP BY hash
+                    HAVING ( COUNT(hash) > 1 )
+                    ORDER BY MIN(relpath)""")
 
-    return dupes_by_hash
+    # SQLite doesn't promise any order within a group, so sort each one;
+    # sorting by path makes it easier to go through by
+    # hand and decide what to do with each file
+    return {file_hash: sorted(json.loads(paths)) for file_hash, paths in iter_rows(c)}
 
 
 def db_query_changed(c):
-    """Find files that may be changed or corrupted"""
-    c.execute('''SELECT substr(a.hash, 0, 20) AS a_short_hash,
-                        substr(b.hash, 0, 20) AS b_short_hash, a.relpath AS relpath
+    """
+    Find files that may be changed or corrupted
+
+    Files that were never hashed (--absorb skips dir_a files whose size
+    matches nothing in dir_b) count as changed, so they aren't overwritten
+    """
+    c.execute(f'''SELECT {short_hash("a.hash")} AS a_short_hash,
+                        {short_hash("b.hash")} AS b_short_hash, a.relpath AS relpath
                     FROM a_files a, b_files b
                     WHERE b.relpath = a.relpath
-                        AND (b.hash != a.hash)''')
-    return c.fetchall()
+                        AND (b.hash IS NOT a.hash)''')
+    return iter_rows(c)
 
 
 def db_full_report(c, to_a_only=False):
-    changed = db_query_changed(c)
-    missing = db_query_missing(c, ignore_paths=[path for _,_,path in changed], a_only=to_a_only)
-    moved = db_query_moved(c)
-    duplicates = db_query_duplicates(c)
-    return {"changed": changed, "missing": missing,
-            "moved": moved, "duplicates": duplicates}
+    db_file = c.execute("PRAGMA database_list").fetchone()[2]
+    if not db_file:
+        # in-memory databases can't be shared between connections
+        changed = list(db_query_changed(c))
+        missing = list(db_query_missing(c, ignore_paths=[path for _,_,path in changed], a_only=to_a_only))
+        moved = list(db_query_moved(c))
+        duplicates = db_query_duplicates(c)
+        return {"changed": changed, "missing": missing,
+                "moved": moved, "duplicates": duplicates}
+
+    def run(query, *args, **kwargs):
+        """Run query on its own connection so it can read alongside the others"""
+        conn = sqlite3.connect(db_file)
+        try:
+            result = query(conn.cursor(), *args, **kwargs)
+            return result if isinstance(result, dict) else list(result)
+        finally:
+            conn.close()
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        changed = executor.submit(run, db_query_changed)
+        moved = executor.submit(run, db_query_moved)
+        duplicates = executor.submit(run, db_query_duplicates)
+        # missing skips the changed files, so it has to wait for them
+        missing = executor.submit(run, db_query_missing,
+            ignore_paths=[path for _,_,path in changed.result()], a_only=to_a_only)
+        return {"changed": changed.result(), "missing": missing.result(),
+                "moved": moved.result(), "duplicates": duplicates.result()}
 
 
 def populate_new_db(cursor, dir_a, dir_b, get_a_hashes=True):
@@ -210,27 +544,72 @@ def populate_new_db(cursor, dir_a, dir_b, get_a_hashes=True):
     def add_to_b(*args):
         write_queue.put(("b_files", *args))
 
-    a_thread = threading.Thread(target=grok_dir,
+    def walk(*args, **kwargs):
+        """Run grok_dir, then queue None to say this walker is done"""
+        try:
+            grok_dir(*args, **kwargs)
+        finally:
+            write_queue.put(None)
+
+    db_drop_indices(cursor)
+
+    # both directory walkers feed the same pool of hashing threads
+    executor = ThreadPoolExecutor(max_workers=HASH_WORKERS)
+    a_thread = threading.Thread(target=walk,
         args=(dir_a, add_to_a),
-        kwargs={"get_hashes": get_a_hashes})
-    b_thread = threading.Thread(target=grok_dir,
-        args=(dir_b, add_to_b))
+        kwargs={"get_fingerprints": get_a_hashes, "executor": executor})
+    b_thread = threading.Thread(target=walk,
+        args=(dir_b, add_to_b),
+        kwargs={"executor": executor})
     a_thread.start()
     b_thread.start()
 
-    while a_thread.is_alive() or b_thread.is_alive():
-        try:
-            table, file_hash, file_size, the_dir, relpath = write_queue.get(timeout=0.05)
-        except queue.Empty:
-            continue
-        cursor.execute(
-            f"INSERT INTO {table} VALUES (?, ?, ?, ?)",
-            (file_hash, file_size, the_dir, relpath)
-        )
+    batches = {"a_files": [], "b_files": []}
+
+    def flush():
+        for table, rows in batches.items():
+            if rows:
+                cursor.executemany(f"""
+                    INSERT INTO {table} (fingerprint, size, start_dir, relpath, inode)
+                    VALUES (?, ?, ?, ?, ?)""", rows)
+                rows.clear()
         cursor.connection.commit()
 
+    # keep going until both walkers have said they're done
+    walkers_left = 2
+    last_flush = time.monotonic()
+    while walkers_left:
+        # block for the next row, then grab whatever else is already waiting
+        items = [write_queue.get()]
+        while len(items) < BATCH_ROWS:
+            try:
+                items.append(write_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        for item in items:
+            if item is None:
+                walkers_left -= 1
+                continue
+            table, *row = item
+            batches[table].append(row)
+
+        queued = sum(len(rows) for rows in batches.values())
+        if queued >= BATCH_ROWS or time.monotonic() - last_flush >= BATCH_SECONDS:
+            flush()
+            last_flush = time.monotonic()
+    flush()
+    db_create_indices(cursor)
+
     a_thread.join()
     b_thread.join()
+    if get_a_hashes:
+        db_resolve_hashes(cursor, executor)
+    executor.shutdown()
+
+    # give the query planner table statistics to pick join orders with
+    cursor.execute("ANALYZE")
+    cursor.connection.commit()
 
 
 def choose_one(choices):
@@ -258,6 +637,11 @@ def choose_one(choices):
             print("Didn't catch that...")
 
 
+def open_script(path):
+    """Open a shell script for writing, buffered and with a UTF-8 BOM"""
+    return open(path, "w", encoding="utf-8-sig", newline="\n", buffering=SCRIPT_BUFFER)
+
+
 def create_dedup_script(duplicates):
     """
     Create a script that will eliminate duplicates by asking the
@@ -269,17 +653,14 @@ def create_dedup_script(duplicates):
         print("No duplicates found...")
         return
 
-    script = open("dedup.sh", "wb")
-    script.write(codecs.BOM_UTF8)
-    script.write(bytes("#! /bin/sh\n", "utf-8"))
-
+    lines = ["#! /bin/sh"]
     for short_hash, dupes in duplicates.items():
         # ask the user what to do with the list we have
         remove_these = choose_one(dupes)
-        for fname in remove_these:
-            script.write(bytes("rm {}\n".format(shlex.quote(fname)), "utf-8"))
+        lines.extend("rm {}".format(shlex.quote(fname)) for fname in remove_these)
 
-    script.close()
+    with open_script("dedup.sh") as script:
+        script.write("\n".join(lines) + "\n")
     make_executable("dedup.sh")
 
 
@@ -287,11 +668,14 @@ def create_sync_script(missing_files, top_dirs, copy=True):
     """
     Create a script that syncs missing files from one location to another
 
-    missing_files is a list of tuples
+    missing_files is an iterable of tuples
         (hash, top_dir_the_file_can_be_found_in, relative_path_to_the_file)
+    grouped by top_dir, as db_query_missing() yields them
     each tuple represents a file that cannot be found in the other top level dir
     """
-    if len(missing_files) < 1:
+    missing_files = iter(missing_files)
+    first = next(missing_files, None)
+    if first is None:
         print("No files missing from either location")
         return
 
@@ -301,12 +685,12 @@ def create_sync_script(missing_files, top_dirs, copy=True):
         "A": top_dirs[1],
         "B": top_dirs[0],
     }
+    alias_of = {top_dir: alias for alias, top_dir in dir_alias.items()}
 
-    script = open("sync.sh", "wb")
-    script.write(codecs.BOM_UTF8)
+    script = open_script("sync.sh")
 
     def write_cmd(cmd):
-        script.write(bytes(cmd + "\n", "utf-8"))
+        script.write(cmd + "\n")
 
     write_cmd(dedent(f"""
         #! /usr/bin/env sh
@@ -314,42 +698,48 @@ def create_sync_script(missing_files, top_dirs, copy=True):
         B={shlex.quote(dir_alias["B"])}
         RET_DIR=$(pwd)
         """).strip())
-    if copy:
-        if platform.system() == "Darwin":
-            write_cmd("CMD='ditto -v'")
-        else:
-            write_cmd("CMD='cp -v --parents'")
-    else:
+    # settle on the command for this run once, rather than per file
+    if not copy:
         write_cmd("CMD='mv'")
 
-    # write the commands that copy files from A to B
-    write_cmd('cd "$A"')
-    for _, start_dir, relpath in missing_files:
-        if start_dir != dir_alias["A"]:
-            continue
-        full_dest = os.path.join(dir_alias["B"], relpath)
-        if copy:
-            write_cmd(f"$CMD {shlex.quote(relpath)} {shlex.quote(full_dest)}")
-        else:
-            dirname = os.path.dirname(relpath)
-            write_cmd(f'mkdir -p "$B/{dirname}" && $CMD "{relpath}" "$B/{relpath}"')
-
-    # write the commands that copy files from B to A
-    write_cmd('cd "$B"')
-    for _, start_dir, relpath in missing_files:
-        if start_dir != dir_alias["B"]:
-            continue
-        if copy:
-            write_cmd(f'$CMD {shlex.quote(relpath)} $A')
-        else:
-            dirname = os.path.dirname(relpath)
-            write_cmd(f'mkdir -p "$A/{dirname}" && $CMD "{relpath}" "$A/{relpath}"')
+        def command(dest, relpath):
+            quoted = shlex.quote(relpath)
+            quoted_dir = shlex.quote(os.path.dirname(relpath))
+            return f'mkdir -p "${dest}"/{quoted_dir} && $CMD {quoted} "${dest}"/{quoted}'
+    elif platform.system() == "Darwin":
+        write_cmd("CMD='ditto -v'")
+
+        def command(dest, relpath):
+            # ditto creates intermediate dirs given the full destination path
+            quoted = shlex.quote(relpath)
+            return f'$CMD {quoted} "${dest}"/{quoted}'
+    else:
+        write_cmd("CMD='cp -v --parents'")
+
+        def command(dest, relpath):
+            # --parents recreates relpath under the destination dir
+            return f'$CMD {shlex.quote(relpath)} "${dest}"'
+
+    # one pass: change into each top dir as its group of files starts,
+    # and send its files to the other top dir
+    other_alias = {"A": "B", "B": "A"}
+    n_written = 0
+    current_dir = None
+    for _, start_dir, relpath in chain([first], missing_files):
+        if start_dir != current_dir:
+            if start_dir not in alias_of:
+                continue
+            current_dir = start_dir
+            dest = other_alias[alias_of[start_dir]]
+            write_cmd(f'cd "${alias_of[start_dir]}"')
+        write_cmd(command(dest, relpath))
+        n_written += 1
 
     # close out the script
     write_cmd('cd "$RET_DIR"')
     script.close()
     make_executable("sync.sh")
-    print(f"Wrote {len(missing_files)} commands to sync.sh")
+    print(f"Wrote {n_written} commands to sync.sh")
 
 
 def get_dirs(c):
@@ -364,7 +754,7 @@ def populate_db_for_absorb(cursor, dir_a, dir_b):
     Absorb all files from dir_b into dir_a, but only if
     they aren't already in dir_a
 
-    This does it quicker than --consolidate by only hashing
+    This does it quicker than --consolidate by only fingerprinting
     those files from dir_a that match the size of those in dir_b
 
     We default to copying everything from dir_b into dir_a unless
@@ -373,27 +763,32 @@ def populate_db_for_absorb(cursor, dir_a, dir_b):
     populate_new_db(cursor, dir_a, dir_b, get_a_hashes=False)
 
     # find all files in dir_a that are the same size as ones from dir_b
-    # because we're going to hash only those files next
+    # because we're going to fingerprint only those files next
     cursor.execute("""
-        SELECT start_dir, relpath
-            FROM a_files
-            WHERE a_files.size IN (SELECT size FROM b_files)
-        """)
+        SELECT a.start_dir, a.relpath
+            FROM a_files a
+            WHERE EXISTS (SELECT 1 FROM b_files b WHERE b.size = a.size)
+        """ + ("ORDER BY a.inode" if DISK_ORDER else ""))
     size_matches = cursor.fetchall()
 
     print(f"Found {len(size_matches)} files that matched sizes")
 
-    for start_dir, relpath in size_matches:
-        full_path = os.path.join(start_dir, relpath)
-        print(f"Hashing file: {full_path}")
-        file_hash = get_hash(full_path)
-        cursor.execute("""
+    files = ((os.path.join(start_dir, relpath), start_dir, relpath)
+             for start_dir, relpath in size_matches)
+    with ThreadPoolExecutor(max_workers=HASH_WORKERS) as executor:
+        updates = []
+        for (full_path, start_dir, relpath), fingerprint in map_bounded(executor, get_fingerprint, files):
+            print(f"Fingerprinted file: {full_path}")
+            updates.append((fingerprint, start_dir, relpath))
+        cursor.executemany("""
             UPDATE a_files
-            SET hash = ?
+            SET fingerprint = ?
             WHERE start_dir = ? AND relpath = ?
-        """, (file_hash, start_dir, relpath))
+        """, updates)
         cursor.connection.commit()
 
+        db_resolve_hashes(cursor, executor)
+
 
 if __name__ == "__main__":
     import argparse
@@ -408,6 +803,12 @@ if __name__ == "__main__":
         default='/Users/clark/Documents/src/archive_diff/site_a')
     parser.add_argument("dir_b", nargs="?",
         default='/Users/clark/Documents/src/archive_diff/site_b')
+    parser.add_argument("--hash", choices=sorted(HASHERS), default=DEFAULT_HASH,
+        help=f"Hash algorithm to identify files with (default: {DEFAULT_HASH})")
+    parser.add_argument("--cache",
+        help="Name of a database file to remember file hashes and fingerprints in between runs")
+    parser.add_argument("--disk-order", action=argparse.BooleanOptionalAction,
+        help="Read files in inode order (default: on if a directory is on a spinning disk)")
     parser.add_argument("--report", action="store_true",
         help="Report all the differences found")
     parser.add_argument("--dedup", action="store_true",
@@ -425,7 +826,17 @@ if __name__ == "__main__":
     if args.absorb:
         args.consolidate = True
 
+    HASH_NAME = args.hash
+    HASHER = HASHERS[HASH_NAME]
+    if args.cache:
+        open_hash_cache(args.cache)
+
     was_pre_existing = os.path.isfile(args.db)
+    # the directories are only read when populating a new database
+    if args.disk_order is None and not was_pre_existing:
+        args.disk_order = any(is_rotational(d) for d in (args.dir_a, args.dir_b))
+    DISK_ORDER = bool(args.disk_order)
+
     conn, cursor = db_setup(db_file=args.db)
     if not was_pre_existing:
         if args.absorb:
@@ -433,9 +844,8 @@ if __name__ == "__main__":
         else:
             populate_new_db(cursor, args.dir_a, args.dir_b)
 
-    report = db_full_report(cursor, to_a_only=args.consolidate)
-
     if args.report:
+        report = db_full_report(cursor, to_a_only=args.consolidate)
         print("Moved:\n\t" +      "\n\t".join(map(str, report["moved"])))
         print("Changed:\n\t" +    "\n\t".join(map(str, report["changed"])))
         print("Missing:\n\t" +    "\n\t".join(map(str, report["missing"])))
@@ -445,9 +855,19 @@ if __name__ == "__main__":
             print("\t\t" + "\n\t\t".join(map(str, file_list)))
 
     if args.dedup:
-        create_dedup_script(report['duplicates'])
+        create_dedup_script(report['duplicates'] if args.report
+                            else db_query_duplicates(cursor))
 
     if args.sync or args.consolidate:
-        create_sync_script(report['missing'], get_dirs(cursor), copy=not args.move)
-
+        if args.report:
+            missing = report['missing']
+        else:
+            # without a report to print, stream the missing files straight
+            # from the database into the script
+            changed = [path for _,_,path in db_query_changed(cursor)]
+            missing = db_query_missing(conn.cursor(), ignore_paths=changed,
+                                       a_only=args.consolidate)
+        create_sync_script(missing, get_dirs(cursor), copy=not args.move)
+
+    close_hash_cache()
     conn.close()